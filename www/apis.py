@@ -1,13 +1,15 @@
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64, binascii
 
 class Page(object):
     '''
     Page object for display pages.
     '''
 
-    def __init__(self, item_count, page_index=1, page_size=10):
+    def __init__(self, item_count, page_index=1, page_size=10, cursor=None):
         '''
         Init Pagination by item_count, page_index and page_size.
+        With cursor (keyset mode) item_count is not needed and page_index is ignored:
+        rows are fetched after the seek position and has_next is known after seek_to().
         >>> p1 = Page(100, 1)
         >>> p1.page_count
         10
@@ -29,7 +31,30 @@ class Page(object):
         90
         >>> p3.limit
         10
+        >>> p4 = Page(None, cursor='', page_size=2)
+        >>> p4.seek is None, p4.limit
+        (True, 3)
+        >>> p4.seek_to([dict(id='c', created_at=3.0), dict(id='b', created_at=2.0), dict(id='a', created_at=1.0)])
+        [{'id': 'c', 'created_at': 3.0}, {'id': 'b', 'created_at': 2.0}]
+        >>> p4.has_next
+        True
+        >>> Page(None, cursor=p4.next_cursor).seek
+        (2.0, 'b')
         '''
+        self.next_cursor = None
+        if cursor is not None:
+            self.item_count = item_count
+            self.page_size = page_size
+            self.page_count = None
+            self.page_index = 1
+            self.seek = decode_cursor(cursor) if cursor else None
+            self.offset = 0
+            # fetch one more row to know if there is a next page:
+            self.limit = page_size + 1
+            self.has_next = False
+            self.has_previous = self.seek is not None
+            return
+        self.seek = None
         self.item_count = item_count
         self.page_size = page_size
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
@@ -44,6 +69,17 @@ class Page(object):
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
 
+    def seek_to(self, items):
+        '''
+        Trim items fetched in keyset mode to page_size and set next_cursor by the last one.
+        '''
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.has_next:
+            last = items[-1]
+            self.next_cursor = encode_cursor(last['created_at'], last['id'])
+        return items
+
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
@@ -80,6 +116,23 @@ class APIPermissionError(APIError):
     def __init__(self, message=''):
         super(APIPermissionError, self).__init__('permission:forbidden', 'permission', message)
 
+def encode_cursor(created_at, id):
+    '''
+    Encode seek position (created_at, id) as opaque continuation token.
+    >>> decode_cursor(encode_cursor(1513400000.5, '001'))
+    (1513400000.5, '001')
+    '''
+    s = json.dumps([created_at, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        created_at, id = json.loads(s.decode('utf-8'))
+        return float(created_at), str(id)
+    except (ValueError, TypeError, binascii.Error):
+        raise APIValueError('cursor', 'Invalid cursor.')
+
 if __name__=='__main__':
     import doctest
     doctest.testmod()
@@ -3,16 +3,45 @@
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, time, itertools, hashlib, gzip, mimetypes, signal, socket, argparse
 from datetime import datetime
 from config import configs
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-import orm
-from lxfweb import add_routes, add_static
+import orm, metrics, encoder, cache, render
+from lxfweb import add_routes, add_static, is_public, STATIC_PREFIX, STATIC_PATH
 from handlers import cookie2user, COOKIE_NAME
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 每个子系统一个logger，级别和采样率由configs.logging配置:
+request_logger = logging.getLogger('app.request')
+auth_logger = logging.getLogger('app.auth')
+response_logger = logging.getLogger('app.response')
+
+class SampleFilter(logging.Filter):
+    '''
+    Pass 1 of every n records.
+    '''
+    def __init__(self, n):
+        super(SampleFilter, self).__init__()
+        self._counter = itertools.count()
+        self.n = n
+
+    def filter(self, record):
+        return next(self._counter) % self.n == 0
+
+def init_logging(**kw):
+    for name, level in kw.get('levels', {}).items():
+        logging.getLogger(name).setLevel(level)
+    for name, n in kw.get('sample', {}).items():
+        if n > 1:
+            logging.getLogger(name).addFilter(SampleFilter(n))
+
 #初始化jinja2，方便其他函数使用
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
@@ -24,6 +53,12 @@ def init_jinja2(app, **kw):
         variable_end_string = kw.get('variable_end_string', '}}'),
         auto_reload = kw.get('auto_reload', True)
     )
+    # 编译后的模板字节码缓存到目录，worker重启后不用重新编译:
+    bytecode_cache = kw.get('bytecode_cache', None)
+    if bytecode_cache:
+        os.makedirs(bytecode_cache, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+        logging.info('set jinja2 bytecode cache: %s' % bytecode_cache)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
@@ -33,8 +68,20 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if kw.get('precompile', False):
+        precompile_templates(env)
     app['__templating__'] = env
 
+# 启动时加载所有模板，第一个请求不用等编译
+def precompile_templates(env):
+    total = time.perf_counter()
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        start = time.perf_counter()
+        env.get_template(name)
+        logging.info('compiled template %s in %.1f ms' % (name, (time.perf_counter() - start) * 1000))
+    logging.info('compiled %s templates in %.1f ms' % (len(names), (time.perf_counter() - total) * 1000))
+
 
 # middleware是一种拦截器，一个URL在被某个函数处理前，可以经过一系列的middleware的处理。
 # middleware的用处就在于把通用的功能从每个URL处理函数中拿出来，集中放到一个地方。
@@ -43,7 +90,7 @@ def logger_factory(app, handler):
     @asyncio.coroutine
     def logger(request):
         # 记录日志
-        logging.info('Request: %s %s' % (request.method, request.path))
+        request_logger.info('Request: %s %s', request.method, request.path)
         # 继续处理请求
         return (yield from handler(request))
     return logger
@@ -51,18 +98,115 @@ def logger_factory(app, handler):
 
 
 
+# 记录每个请求各阶段(auth, handler, render, json, sql)的耗时，写入Server-Timing头和metrics直方图
+@asyncio.coroutine
+def timing_factory(app, handler):
+    @asyncio.coroutine
+    def timing(request):
+        timer, token = metrics.begin_request(request.path)
+        try:
+            r = yield from handler(request)
+        finally:
+            total_ms = metrics.end_request(token)
+        if isinstance(r, web.StreamResponse) and not r.prepared:
+            r.headers['Server-Timing'] = timer.server_timing(total_ms)
+        return r
+    return timing
+
+# 压缩响应: 静态文件优先用precompress.py生成的.br/.gz文件，动态的html/json超过min_size时实时压缩
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+def accepted_encodings(request):
+    encodings = set()
+    for e in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = e.partition(';')
+        if params.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.add(name.strip().lower())
+    return encodings
+
+def precompressed_static(request, encodings):
+    ' return FileResponse of a fresh .br/.gz sibling of the requested static file, or None. '
+    path = os.path.normpath(os.path.join(STATIC_PATH, request.path[len(STATIC_PREFIX):]))
+    if not path.startswith(STATIC_PATH + os.sep) or not os.path.isfile(path):
+        return None
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in encodings and os.path.isfile(path + ext) and os.path.getmtime(path + ext) >= os.path.getmtime(path):
+            resp = web.FileResponse(path + ext)
+            resp.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            resp.headers['Content-Encoding'] = encoding
+            return resp
+    return None
+
+@asyncio.coroutine
+def compress_factory(app, handler):
+    min_size = configs.compress.min_size
+    level = configs.compress.level
+    static_cache_control = 'public, max-age=%s' % configs.compress.static_max_age
+    @asyncio.coroutine
+    def compress(request):
+        encodings = accepted_encodings(request)
+        if request.path.startswith(STATIC_PREFIX) and request.method in ('GET', 'HEAD'):
+            r = precompressed_static(request, encodings)
+            if r is None:
+                r = yield from handler(request)
+            if isinstance(r, web.StreamResponse) and not r.prepared and r.status == 200:
+                r.headers['Cache-Control'] = static_cache_control
+                r.headers['Vary'] = 'Accept-Encoding'
+            return r
+        r = yield from handler(request)
+        if not isinstance(r, web.Response) or r.prepared or 'Content-Encoding' in r.headers:
+            return r
+        body = r.body
+        if not isinstance(body, bytes) or len(body) < min_size or not r.content_type.startswith(COMPRESSIBLE_TYPES):
+            return r
+        r.headers['Vary'] = 'Accept-Encoding'
+        start = time.perf_counter()
+        if brotli is not None and 'br' in encodings:
+            r.body = brotli.compress(body, quality=level)
+            r.headers['Content-Encoding'] = 'br'
+        elif 'gzip' in encodings:
+            r.body = gzip.compress(body, compresslevel=level)
+            r.headers['Content-Encoding'] = 'gzip'
+        else:
+            return r
+        # same content, other bytes: a strong ETag must not be shared with the identity encoding
+        etag = r.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            r.headers['ETag'] = 'W/' + etag
+        metrics.record('compress', start)
+        return r
+    return compress
+
+# 每个请求一个UnitOfWork: 同一主键只查一次数据库，markDirty()的Model在请求结束时一起update
+@asyncio.coroutine
+def uow_factory(app, handler):
+    @asyncio.coroutine
+    def uow(request):
+        request.__uow__, token = orm.begin_unit_of_work()
+        try:
+            r = yield from handler(request)
+            yield from request.__uow__.flush()
+            return r
+        finally:
+            orm.end_unit_of_work(token)
+    return uow
+
 @asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
     def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
+        if is_public(request):
+            return (yield from handler(request))
+        start = time.perf_counter()
+        auth_logger.debug('check user: %s %s', request.method, request.path)
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
             user = yield from cookie2user(cookie_str)
             if user:
-                logging.info('set current user: %s' % user.email)
+                auth_logger.debug('set current user: %s', user.email)
                 request.__user__ = user
+        metrics.record('auth', start)
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
         return (yield from handler(request))
@@ -75,18 +219,57 @@ def data_factory(app, handler):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = yield from request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                request_logger.debug('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = yield from request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                request_logger.debug('request form: %s', request.__data__)
         return (yield from handler(request))
     return parse_data
 
+# 强ETag: 响应体的sha1; 弱ETag: handler返回的'__etag__'版本号(渲染模板之前就能比较)。
+# 模板里datetime_filter输出'3分钟前'这样的相对时间，同一版本的响应体会变，所以版本号
+# 只是弱ETag，并且加上当前分钟，相对时间最多过时1分钟
+def make_etag(*parts):
+    return '"%s"' % hashlib.sha1('\x00'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+def etag_matches(request, etag):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    inm = request.headers.get('If-None-Match')
+    if not inm:
+        return False
+    for tag in inm.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag or tag == 'W/' + etag:
+            return True
+    return False
+
+def conditional_response(request, body, content_type, etag=None):
+    ' return 304 if If-None-Match matches, otherwise the body with its ETag. '
+    if request.method == 'GET':
+        if etag is None:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if etag_matches(request, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+    resp = web.Response(body=body)
+    resp.content_type = content_type
+    if etag is not None:
+        resp.headers['ETag'] = etag
+    return resp
+
 @asyncio.coroutine
 def response_factory(app, handler):  # 这个中间件把返回值转换为web.Response对象再返回
     @asyncio.coroutine
     def response(request):
-        logging.info('Response handler...')
+        response_logger.debug('Response handler...')
+        # 未登录用户访问的页面内容都一样，直接从page_cache返回:
+        cache_key = None
+        if request.method == 'GET' and request.__user__ is None and getattr(request.match_info.handler, '__page_cache__', False):
+            cache_key = (request.path, request.query_string)
+            cached = cache.page_cache.get(cache_key)
+            if cached is not None:
+                body, etag = cached
+                return conditional_response(request, body, 'text/html;charset=utf-8', etag)
         r = yield from handler(request)
         if isinstance(r, web.StreamResponse):
             return r
@@ -100,16 +283,41 @@ def response_factory(app, handler):  # 这个中间件把返回值转换为web.R
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
+        if encoder.is_streaming(r):
+            resp = web.StreamResponse()
+            resp.content_type = 'application/json;charset=utf-8'
+            resp.enable_chunked_encoding()
+            yield from resp.prepare(request)
+            try:
+                yield from encoder.write_stream(resp, r)
+            finally:
+                for v in r.values():
+                    if isinstance(v, orm.SelectCursor):
+                        yield from v.close()
+            return resp
         if isinstance(r, dict):
             template = r.get('__template__')
+            start = time.perf_counter()
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
+                resp = conditional_response(request, encoder.dumps(r), 'application/json;charset=utf-8')
+                metrics.record('json', start)
                 return resp
             else:
+                etag = None
+                version = r.get('__etag__')
+                if version is not None:
+                    user = request.__user__
+                    etag = 'W/' + make_etag(template, version, user.id if user else '', user.admin if user else '', int(time.time() // 60))
+                    if etag_matches(request, etag):
+                        return web.Response(status=304, headers={'ETag': etag})
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
+                body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                if etag is None:
+                    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if cache_key is not None:
+                    cache.page_cache.put(cache_key, (body, etag), size=len(body), tags=(request.path,))
+                resp = conditional_response(request, body, 'text/html;charset=utf-8', etag)
+                metrics.record('render', start)
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
@@ -137,18 +345,75 @@ def datetime_filter(t):  # 拦截器
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 @asyncio.coroutine
-def init(loop):
+def init(loop, sock=None, workers=1):
+    init_logging(**configs.logging)
+    orm.set_query_monitor(**configs.orm)
+    if workers > 1:
+        # 每个worker有自己的缓存，失效只发生在处理请求的worker里:
+        cache.limit_ttl(configs.cache.multi_worker_ttl)
+        orm.COUNTER_TTL = min(orm.COUNTER_TTL, configs.cache.multi_worker_ttl)
+    # 渲染进程池在创建数据库连接和绑定端口之前启动:
+    render.init_executor(**configs.render)
     yield from orm.create_pool(loop=loop, **configs.db)
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, response_factory, auth_factory
+        logger_factory, timing_factory, compress_factory, uow_factory, auth_factory, response_factory
     ])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_jinja2(app, filters=dict(datetime=datetime_filter), **configs.templates)
     add_routes(app, 'handlers')
     add_static(app)
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    handler = app.make_handler()
+    if sock is None:
+        srv = yield from loop.create_server(handler, configs.server.host, configs.server.port, reuse_port=configs.server.reuse_port)
+    else:
+        # supervisor.py预先绑定的socket，所有worker共用:
+        srv = yield from loop.create_server(handler, sock=sock)
+    logging.info('server started at http://%s:%s, pid %s...' % (configs.server.host, configs.server.port, os.getpid()))
+    return srv, handler
+
+@asyncio.coroutine
+def shutdown(srv, handler):
+    ' stop accepting connections, finish requests in flight and close the db pool. '
+    logging.info('server shutting down, pid %s...' % os.getpid())
+    srv.close()
+    yield from srv.wait_closed()
+    yield from handler.shutdown(configs.server.shutdown_timeout)
+    yield from orm.close_pool()
+    render.shutdown_executor()
+
+def heartbeat(loop, fd, interval, stop):
+    ' write a byte to supervisor.py every interval seconds while the loop is responsive. '
+    try:
+        os.write(fd, b'.')
+    except BlockingIOError:
+        pass
+    except OSError:
+        logging.warning('supervisor gone, pid %s exits.' % os.getpid())
+        stop()
+        return
+    loop.call_later(interval, heartbeat, loop, fd, interval, stop)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the web app in this process.')
+    parser.add_argument('--fd', type=int, help='serve on this inherited listening socket, see supervisor.py')
+    parser.add_argument('--heartbeat-fd', type=int, help='write heartbeats to this inherited pipe, see supervisor.py')
+    parser.add_argument('--workers', type=int, default=1, help='number of workers started by supervisor.py')
+    args = parser.parse_args()
+    sock = None if args.fd is None else socket.socket(fileno=args.fd)
+    loop = asyncio.get_event_loop()
+    srv, handler = loop.run_until_complete(init(loop, sock, args.workers))
+    stopping = False
+    def stop():
+        nonlocal stopping
+        if not stopping:
+            stopping = True
+            asyncio.ensure_future(shutdown(srv, handler)).add_done_callback(lambda f: loop.stop())
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop)
+    if args.heartbeat_fd is not None:
+        os.set_blocking(args.heartbeat_fd, False)
+        heartbeat(loop, args.heartbeat_fd, configs.server.heartbeat_interval, stop)
+    loop.run_forever()
+    loop.close()
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    main()
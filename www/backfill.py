@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Background job: render html_content for blogs saved before the column existed.
+
+Usage: python3 backfill.py [batch_size]
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import sys, asyncio
+
+import orm, markdown2
+from config import configs
+from models import Blog
+
+@asyncio.coroutine
+def backfill_blog_html(batch_size=100):
+    # one pass over a server-side cursor, instead of re-scanning for null rows per batch:
+    blogs = Blog.iterate('`html_content` is null', batch_size=batch_size)
+    total = 0
+    while True:
+        try:
+            blog = yield from blogs.__anext__()
+        except StopAsyncIteration:
+            break
+        html = markdown2.markdown(blog.content)
+        # only fill rows not rendered meanwhile by api_update_blog:
+        yield from orm.execute('update `blogs` set `html_content`=? where `id`=? and `html_content` is null', [html, blog.id])
+        total = total + 1
+        if total % batch_size == 0:
+            logging.info('backfill html_content: %s blogs done.' % total)
+    logging.info('backfill html_content: %s blogs done.' % total)
+    return total
+
+@asyncio.coroutine
+def main(loop, batch_size):
+    yield from orm.create_pool(loop=loop, **configs.db)
+    yield from backfill_blog_html(batch_size)
+
+if __name__ == '__main__':
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, batch_size))
+    loop.close()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of markdown2.Markdown.convert over a generated corpus.
+
+Reports per document the best time of several runs, throughput in MB/s and the time
+spent in the main stages of the converter. Stages nest (_do_links runs inside
+_run_span_gamut, inside _run_block_gamut), times are inclusive.
+
+Usage: python3 bench_markdown2.py [-n runs] [--only name] [--save | --compare] [--baseline file]
+
+--save writes times and sha1 of the html to the baseline file, --compare reports the
+change against it and exits with 1 if a document got slower by more than --tolerance
+or its html changed.
+'''
+
+import os, sys, time, json, random, hashlib, argparse, functools
+
+import markdown2
+
+STAGES = ('_hash_html_blocks', '_run_block_gamut', '_run_span_gamut', '_do_links', '_form_paragraphs')
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_markdown2.json')
+
+WORDS = ('the', 'event', 'loop', 'blocks', 'while', 'markdown', 'renders', 'a', 'long', 'post', 'of',
+         'pure', 'python', 'regex', 'work', 'and', 'every', 'other', 'request', 'waits', '中文', '博客')
+
+def log(s):
+    print('[Bench] %s' % s)
+
+def sentence(rnd, n=12):
+    return ' '.join(rnd.choice(WORDS) for i in range(n)).capitalize() + '.'
+
+def prose(rnd):
+    return '\n\n'.join(' '.join(sentence(rnd) for i in range(6)) for p in range(600))
+
+def nested_lists(rnd):
+    L = []
+    for i in range(150):
+        for depth in range(8):
+            L.append('%s* %s' % ('    ' * depth, sentence(rnd, 6)))
+        L.append('')
+        for depth in range(4):
+            L.append('%s1. %s' % ('    ' * depth, sentence(rnd, 6)))
+        L.append('')
+    return '\n'.join(L)
+
+def tables(rnd):
+    L = []
+    for t in range(20):
+        L.append('| id | name | value | note |')
+        L.append('|----|:-----|------:|:----:|')
+        for i in range(100):
+            L.append('| %s | %s | %s | *%s* |' % (i, rnd.choice(WORDS), rnd.randint(0, 10000), rnd.choice(WORDS)))
+        L.append('')
+    return '\n'.join(L)
+
+def links(rnd):
+    L = []
+    for i in range(2000):
+        kind = i % 4
+        if kind == 0:
+            L.append('see [%s](http://example.com/%s "title %s")' % (rnd.choice(WORDS), i, i))
+        elif kind == 1:
+            L.append('see [%s][ref%s]' % (rnd.choice(WORDS), i % 50))
+        elif kind == 2:
+            L.append('![image %s](/static/img/%s.png)' % (i, i))
+        else:
+            L.append('<http://example.com/auto/%s>' % i)
+        if i % 10 == 9:
+            L.append('\n')
+    L.append('\n')
+    for i in range(50):
+        L.append('[ref%s]: http://example.com/ref/%s  "Ref %s"\n' % (i, i, i))
+    return ' '.join(L)
+
+def code_blocks(rnd):
+    L = []
+    for b in range(40):
+        L.append('```')
+        for i in range(150):
+            L.append('    x[%s] = foo(*args, **kw) if a < b and c > d else "<%s>"' % (i, rnd.choice(WORDS)))
+        L.append('```')
+        L.append('')
+        L.append(sentence(rnd))
+        L.append('')
+    return '\n'.join(L)
+
+def brackets(rnd):
+    # code pasted into prose: many [ without a link behind them
+    L = []
+    for i in range(300):
+        L.append('a[i][j] = b[c[d[%s]]] + m[k]; then [unclosed %s and arr[0' % (i, rnd.choice(WORDS)))
+        if i % 5 == 4:
+            L.append('[real link](http://example.com/%s)\n\n' % i)
+    # one long paragraph of brackets never closed:
+    L.append('\n\n' + 'x [a [b [c ' * 500 + '\n\n')
+    # inline links with a title whose parenthesis never closes:
+    L.append('\n\n' + '[a](b "t" ' * 2000 + '\n\n')
+    return ' '.join(L)
+
+def emphasis(rnd):
+    L = []
+    for i in range(3000):
+        L.append(rnd.choice(('*a', '_b', '**c', '__d', 'e*', 'f_', '**g**', '*h*', '_i_ j', '***k')))
+        if i % 40 == 39:
+            L.append('\n\n')
+    return ' '.join(L)
+
+# name => (generator, extras)
+CORPUS = (
+    ('prose', prose, None),
+    ('nested_lists', nested_lists, None),
+    ('tables', tables, ['tables']),
+    ('links', links, None),
+    ('code_blocks', code_blocks, ['fenced-code-blocks']),
+    ('brackets', brackets, None),
+    ('emphasis', emphasis, None),
+)
+
+def timed(fn, name, times, depth):
+    @functools.wraps(fn)
+    def wrapper(*args, **kw):
+        # only the outermost call of a stage counts, stages recurse:
+        depth[name] += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kw)
+        finally:
+            depth[name] -= 1
+            if depth[name] == 0:
+                times[name] += time.perf_counter() - start
+    return wrapper
+
+def instrumented():
+    ' return a Markdown subclass timing STAGES, and the dict of the times. '
+    times = dict((name, 0.0) for name in STAGES)
+    depth = dict((name, 0) for name in STAGES)
+    attrs = dict((name, timed(getattr(markdown2.Markdown, name), name, times, depth)) for name in STAGES)
+    return type('TimedMarkdown', (markdown2.Markdown,), attrs), times
+
+def bench(text, extras, runs):
+    ' return best total seconds, stage seconds of that run and the html. '
+    cls, times = instrumented()
+    md = cls(extras=extras)
+    best, best_stages, html = None, None, None
+    for i in range(runs):
+        for name in times:
+            times[name] = 0.0
+        start = time.perf_counter()
+        html = md.convert(text)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best, best_stages = t, dict(times)
+    return best, best_stages, html
+
+def run(runs, only=None):
+    results = dict()
+    rnd = random.Random(20160101)
+    for name, gen, extras in CORPUS:
+        # generate every document, so the corpus does not depend on --only:
+        text = gen(rnd)
+        if only and name not in only:
+            continue
+        size = len(text.encode('utf-8'))
+        t, stages, html = bench(text, extras, runs)
+        results[name] = dict(bytes=size, ms=round(t * 1000, 3), mb_s=round(size / t / 1e6, 3),
+                             stages=dict((k, round(v * 1000, 3)) for k, v in stages.items()),
+                             sha1=hashlib.sha1(html.encode('utf-8')).hexdigest())
+    return results
+
+def report(results, baseline=None, tolerance=0.2):
+    ' print results, return names of documents slower or different than baseline. '
+    print('%-14s %9s %10s %8s  %s' % ('document', 'KB', 'ms', 'MB/s', '  '.join('%s' % s.strip('_') for s in STAGES)))
+    bad = []
+    for name, r in results.items():
+        line = '%-14s %9.1f %10.2f %8.2f  %s' % (name, r['bytes'] / 1024, r['ms'], r['mb_s'],
+                                                 '  '.join('%*.2f' % (len(s.strip('_')), r['stages'][s]) for s in STAGES))
+        b = baseline.get(name) if baseline else None
+        if b:
+            change = r['ms'] / b['ms'] - 1
+            line = line + '  %+.0f%%' % (change * 100)
+            if change > tolerance:
+                line = line + ' SLOWER'
+                bad.append(name)
+            if r['sha1'] != b['sha1']:
+                line = line + ' OUTPUT CHANGED'
+                bad.append(name)
+        print(line)
+    total_bytes = sum(r['bytes'] for r in results.values())
+    total_ms = sum(r['ms'] for r in results.values())
+    if total_ms:
+        print('%-14s %9.1f %10.2f %8.2f' % ('total', total_bytes / 1024, total_ms, total_bytes / total_ms / 1e3))
+    return bad
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark markdown2.Markdown.convert.')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='runs per document, the best counts')
+    parser.add_argument('--only', action='append', help='only this document, may repeat')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file, default %(default)s')
+    parser.add_argument('--save', action='store_true', help='save results as baseline')
+    parser.add_argument('--compare', action='store_true', help='compare results with baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, default %(default)s')
+    args = parser.parse_args()
+    results = run(args.runs, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    bad = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        log('baseline saved to %s' % args.baseline)
+    if bad:
+        log('regressions: %s' % ', '.join(sorted(set(bad))))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
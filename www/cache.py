@@ -0,0 +1,146 @@
+import sys, time, logging
+
+from collections import OrderedDict
+
+from config import configs
+
+class LRUCache(object):
+    '''
+    Bounded in-process LRU cache with optional byte-size accounting and expiry.
+    '''
+
+    def __init__(self, max_items=1024, max_bytes=None, ttl=None):
+        '''
+        Init cache by max_items, (optional) max_bytes and (optional) ttl in seconds.
+        >>> c = LRUCache(max_items=2)
+        >>> c.put('a', 1)
+        >>> c.put('b', 2)
+        >>> c.get('a')
+        1
+        >>> c.put('c', 3)
+        >>> c.get('b') is None
+        True
+        >>> len(c)
+        2
+        >>> c = LRUCache(max_bytes=10)
+        >>> c.put('a', 'x', size=6)
+        >>> c.put('b', 'y', size=6)
+        >>> c.get('a') is None
+        True
+        >>> c.size
+        6
+        >>> c.put('c', 'z', size=6, tags=('blog:1',))
+        >>> c.evict_tag('blog:1')
+        1
+        >>> c.get('c') is None
+        True
+        >>> c = LRUCache(ttl=60)
+        >>> c.put('a', 1, ttl=-1)
+        >>> c.get('a') is None
+        True
+        >>> c.put('b', 2, ttl=3600)
+        >>> c._data['b'][3] - time.time() <= 60
+        True
+        '''
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._tags = dict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value, size, tags, expires = self._data[key]
+        except KeyError:
+            self.misses = self.misses + 1
+            return default
+        if expires is not None and expires < time.time():
+            self.pop(key)
+            self.misses = self.misses + 1
+            return default
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return value
+
+    def put(self, key, value, size=None, tags=(), ttl=None):
+        ' put value, kept for ttl seconds but no longer than the ttl of the cache. '
+        if key in self._data:
+            self.pop(key)
+        if size is None:
+            size = sys.getsizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            logging.debug('cache entry too large, skipped: %s bytes' % size)
+            return
+        if ttl is None or (self.ttl is not None and ttl > self.ttl):
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        self._data[key] = (value, size, tuple(tags), expires)
+        self.size = self.size + size
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.max_items or (self.max_bytes is not None and self.size > self.max_bytes):
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        try:
+            value, size, tags, expires = self._data.pop(key)
+        except KeyError:
+            return default
+        self.size = self.size - size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        return value
+
+    def evict_tag(self, tag):
+        ' remove all entries put with tag, return number of removed entries. '
+        keys = self._tags.pop(tag, ())
+        for key in list(keys):
+            self.pop(key)
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+        self.size = 0
+
+    def __str__(self):
+        return 'items: %s, size: %s, hits: %s, misses: %s' % (len(self._data), self.size, self.hits, self.misses)
+
+    __repr__ = __str__
+
+# rendered markdown of blog content, keyed by sha1 of the content:
+html_cache = LRUCache(max_items=configs.cache.html_max_items, max_bytes=configs.cache.html_max_bytes)
+
+# validated session cookie => user dict, see handlers.cookie2user.
+# Any object with get/put/pop/evict_tag may replace it, e.g. a store shared by local workers:
+session_cache = LRUCache(max_items=configs.cache.session_max_items, ttl=configs.cache.session_ttl)
+
+# rendered html of pages for anonymous visitors, keyed by path and query string and tagged
+# by path, see app.response_factory and handlers.invalidate_pages:
+page_cache = LRUCache(max_items=configs.cache.page_max_items, max_bytes=configs.cache.page_max_bytes, ttl=configs.cache.page_ttl)
+
+def limit_ttl(ttl):
+    '''
+    Cap the expiry of sessions and pages at ttl seconds. Run by workers of supervisor.py:
+    evict_tag only reaches the cache of the worker that handled the change.
+    '''
+    for c in (session_cache, page_cache):
+        if c.ttl is None or c.ttl > ttl:
+            c.ttl = ttl
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -1,4 +1,20 @@
 configs = {
+    'server':{
+        'host':'127.0.0.1',
+        'port':9000,
+        # worker processes started by supervisor.py, 0 for one per cpu.
+        # Each worker has its own db pool of up to db.maxsize connections:
+        'workers':0,
+        # True: each worker binds its own SO_REUSEPORT socket and the kernel spreads connections
+        # over them; False: workers share one socket bound by supervisor.py, no connection is
+        # dropped when a worker stops:
+        'reuse_port':False,
+        # seconds between heartbeats of a worker, a worker silent for heartbeat_timeout is killed:
+        'heartbeat_interval':1,
+        'heartbeat_timeout':10,
+        # seconds to finish requests in flight at shutdown:
+        'shutdown_timeout':10
+    },
     'db':{
         'host':'127.0.0.1',
         'port':3306,
@@ -8,5 +24,60 @@ configs = {
     },
     'session':{
         'secret':'AweSome'
+    },
+    'cache':{
+        'html_max_items':1000,
+        'html_max_bytes':32 * 1024 * 1024,
+        'session_max_items':10000,
+        'session_ttl':300,
+        'page_max_items':1000,
+        'page_max_bytes':64 * 1024 * 1024,
+        # pages show relative times like '3分钟前', keep them short-lived:
+        'page_ttl':60,
+        # with more than one worker of supervisor.py, sessions, pages and row counts are
+        # cached per process and a signout, password change or new blog evicts them in the
+        # handling worker only, the others see the change after at most this many seconds:
+        'multi_worker_ttl':5
+    },
+    'compress':{
+        # dynamic responses smaller than this are sent uncompressed:
+        'min_size':1024,
+        'level':6,
+        # Cache-Control max-age of /static/ files:
+        'static_max_age':30 * 86400
+    },
+    'render':{
+        # markdown of at least inline_max_chars is rendered by a pool of worker processes
+        # ('process'), threads ('thread') or inline (None), per worker of supervisor.py:
+        'executor':'process',
+        'workers':2,
+        'inline_max_chars':4096,
+        # 'forkserver' or 'spawn' ('spawn' where forkserver is not available), never 'fork':
+        'start_method':'forkserver'
+    },
+    'templates':{
+        # for production: 'auto_reload':False (no stat of template files per render),
+        # 'bytecode_cache':'/tmp/awesome-jinja2' and 'precompile':True
+        'auto_reload':True,
+        'bytecode_cache':None,
+        'precompile':False
+    },
+    'orm':{
+        # log queries slower than this to 'orm.slow':
+        'slow_query_ms':200,
+        # log a SQL shape issued more often than this in one request to 'orm.repeat':
+        'repeat_query_limit':10
+    },
+    'logging':{
+        # logger name => level, e.g. 'orm': 'DEBUG' logs every SQL:
+        'levels':{
+            'app':'INFO',
+            'lxfweb':'INFO',
+            'orm':'INFO'
+        },
+        # logger name => log 1 of every n records:
+        'sample':{
+            'app.request':1
+        }
     }
 }
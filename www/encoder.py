@@ -0,0 +1,94 @@
+'''
+JSON encoding of handler results straight to utf-8 bytes.
+
+orm.Model is a dict and is encoded natively, apis.Page by its attributes.
+orjson is used when installed, otherwise the C accelerated encoder of the json module.
+'''
+
+import json, logging, asyncio
+
+from apis import Page
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def default(o):
+    '''
+    Encode objects json does not know.
+    >>> default(Page(5, 1, 2))['page_count']
+    3
+    >>> default(object())
+    Traceback (most recent call last):
+      ...
+    TypeError: Object of type object is not JSON serializable
+    '''
+    if isinstance(o, Page):
+        return o.__dict__
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+if orjson is not None:
+    logging.info('json encoder: orjson')
+    def dumps(obj):
+        ' encode obj as utf-8 JSON bytes. '
+        return orjson.dumps(obj, default=default)
+else:
+    def dumps(obj):
+        '''
+        encode obj as utf-8 JSON bytes.
+        >>> dumps(dict(name='廖', ids=(1, 2)))
+        b'{"name":"\\xe5\\xbb\\x96","ids":[1,2]}'
+        '''
+        return _encoder.encode(obj).encode('utf-8')
+
+CHUNK_SIZE = 64 * 1024
+
+def is_streaming(obj):
+    ' True if obj is a dict holding an async iterator, e.g. Model.findAll(stream=True). '
+    return isinstance(obj, dict) and any(hasattr(v, '__anext__') for v in obj.values())
+
+@asyncio.coroutine
+def write_stream(resp, obj, chunk_size=CHUNK_SIZE):
+    '''
+    Write dict obj as JSON to prepared web.StreamResponse resp in chunks,
+    async iterator values are written as arrays item by item.
+    '''
+    buf = bytearray(b'{')
+    first = True
+    for k, v in obj.items():
+        if not first:
+            buf += b','
+        first = False
+        buf += dumps(str(k))
+        buf += b':'
+        if not hasattr(v, '__anext__'):
+            buf += dumps(v)
+            continue
+        buf += b'['
+        it = v.__aiter__()
+        n = 0
+        while True:
+            try:
+                item = yield from it.__anext__()
+            except StopAsyncIteration:
+                break
+            if n > 0:
+                buf += b','
+            n = n + 1
+            buf += dumps(item)
+            if len(buf) >= chunk_size:
+                yield from resp.write(bytes(buf))
+                buf = bytearray()
+        buf += b']'
+    buf += b'}'
+    yield from resp.write(bytes(buf))
+    yield from resp.write_eof()
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -1,10 +1,11 @@
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, base64, asyncio
 from lxfweb import get, post
 from models import User, Comment, Blog, next_id
 from aiohttp import web
-from apis import Page, APIValueError, APIResourceNotFoundError
+from apis import Page, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
 from config import configs
-import markdown2
+from cache import html_cache
+import cache, metrics, encoder, render
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
@@ -37,6 +38,18 @@ def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+@asyncio.coroutine
+def blog2html(blog):
+    '''
+    Render blog content by markdown, cached by sha1 of the content.
+    '''
+    key = hashlib.sha1(blog.content.encode('utf-8')).hexdigest()
+    html = html_cache.get(key)
+    if html is None:
+        html = yield from render.markdown(blog.content)
+        html_cache.put(key, html, tags=('blog:%s' % blog.id,))
+    return html
+
 @asyncio.coroutine
 def cookie2user(cookie_str):
     '''
@@ -51,6 +64,9 @@ def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
+        cached = cache.session_cache.get(cookie_str)
+        if cached is not None:
+            return User(**cached)
         user = yield from User.find(uid)
         if user is None:
             return None
@@ -58,16 +74,28 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        # copy, the loaded user stays in the identity map with its real passwd:
+        user = User(**user)
         user.passwd = '******'
+        # no longer than the cookie, session_cache caps it at its own ttl (see cache.limit_ttl):
+        cache.session_cache.put(cookie_str, dict(user), tags=('user:%s' % uid,), ttl=int(expires) - time.time())
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
-@get('/')
+def invalidate_pages(blog_id, index=True):
+    '''
+    Drop cached anonymous pages showing the blog: /blog/{id} and, if index, all pages of /.
+    '''
+    cache.page_cache.evict_tag('/blog/%s' % blog_id)
+    if index:
+        cache.page_cache.evict_tag('/')
+
+@get('/', page_cache=True)
 def index(*, page='1'):
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
+    num = yield from Blog.findCount()
     page = Page(num)
     if num == 0:
         blogs = []
@@ -79,15 +107,19 @@ def index(*, page='1'):
         'blogs': blogs
     }
 
-@get('/blog/{id}')
+@get('/blog/{id}', page_cache=True)
 def get_blog(id):
     blog = yield from Blog.find(id)
     comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    if blog.html_content is None:
+        # not backfilled yet:
+        blog.html_content = yield from blog2html(blog)
     return {
         '__template__': 'blog.html',
+        # version of the page, checked against If-None-Match before rendering:
+        '__etag__': '%s:%s:%s:%s' % (blog.id, hashlib.sha1(('%s\n%s\n%s' % (blog.name, blog.summary, blog.html_content)).encode('utf-8')).hexdigest(), len(comments), comments[0].id if comments else ''),
         'blog': blog,
         'comments': comments
     }
@@ -104,7 +136,7 @@ def signin():
         '__template__': 'signin.html'
     }
 
-@post('/api/authenticate')
+@post('/api/authenticate', public=True)
 def authenticate(*, email, passwd):
     if not email:
         raise APIValueError('email', 'Invalid email.')
@@ -126,11 +158,14 @@ def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 @get('/signout')
 def signout(request):
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    if cookie_str:
+        cache.session_cache.pop(cookie_str)
     referer = request.headers.get('Referer')
     r = web.HTTPFound(referer or '/')
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
@@ -171,6 +206,10 @@ def manage_edit_blog(*, id):
         'action': '/api/blogs/%s' % id
     }
 
+@get('/manage/metrics')
+def manage_metrics():
+    return metrics.snapshot()
+
 @get('/manage/users')
 def manage_users(*, page='1'):
     return {
@@ -178,11 +217,18 @@ def manage_users(*, page='1'):
         'page_index': get_page_index(page)
     }
 
-@get('/api/comments')
-def api_comments(*, page='1'):
+@get('/api/comments', public=True)
+def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p = Page(None, cursor=cursor)
+        comments = yield from Comment.findAll(orderBy='created_at desc, id desc', limit=p.limit, seek=p.seek)
+        return dict(page=p, comments=p.seek_to(comments))
     page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
+    # comments is the big table, approximate count is fine for the admin pager
+    # as long as it reaches the requested page:
+    page_size = 10
+    num = yield from Comment.findCount(estimate=True, at_least=page_index * page_size)
+    p = Page(num, page_index, page_size)
     if num == 0:
         return dict(page=p, comments=())
     comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
@@ -200,6 +246,7 @@ def api_create_comment(id, request, *, content):
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
     yield from comment.save()
+    invalidate_pages(blog.id, index=False)
     return comment
 
 @post('/api/comments/{id}/delete')
@@ -209,24 +256,50 @@ def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     yield from c.remove()
+    invalidate_pages(c.blog_id, index=False)
     return dict(id=id)
 
-@get('/api/users')
-def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/users', public=True)
+def api_get_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p = Page(None, cursor=cursor)
+        users = yield from User.findAll(orderBy='created_at desc, id desc', limit=p.limit, seek=p.seek)
+        users = p.seek_to(users)
+    else:
+        page_index = get_page_index(page)
+        num = yield from User.findCount()
+        p = Page(num, page_index)
+        if num == 0:
+            return dict(page=p, users=())
+        users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
 
+_EXPORT_MODELS = dict(blogs=Blog, comments=Comment, users=User)
+
+def _mask_passwd(user):
+    user.passwd = '******'
+    return user
+
+@get('/api/export/{table}')
+def api_export(table, request):
+    '''
+    Stream all rows of blogs, comments or users as chunked JSON.
+    '''
+    check_admin(request)
+    cls = _EXPORT_MODELS.get(table)
+    if cls is None:
+        raise APIResourceNotFoundError('table')
+    rows = cls.iterate(orderBy='created_at desc', batch_size=500)
+    if cls is User:
+        rows.map(_mask_passwd)
+    return {table: rows}
+
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
-@post('/api/users')
+@post('/api/users', public=True)
 def api_register_user(*, email, name, passwd):
     if not name or not name.strip():
         raise APIValueError('name')
@@ -246,20 +319,24 @@ def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
-@get('/api/blogs')
-def api_blogs(*, page='1'):
+@get('/api/blogs', public=True)
+def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p = Page(None, cursor=cursor)
+        blogs = yield from Blog.findAll(orderBy='created_at desc, id desc', limit=p.limit, seek=p.seek)
+        return dict(page=p, blogs=p.seek_to(blogs))
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
+    num = yield from Blog.findCount()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
     blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, blogs=blogs)
 
-@get('/api/blogs/{id}')
+@get('/api/blogs/{id}', public=True)
 def api_get_blog(*, id):
     blog = yield from Blog.find(id)
     return blog
@@ -274,7 +351,9 @@ def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    blog.html_content = yield from render.markdown(blog.content)
     yield from blog.save()
+    invalidate_pages(blog.id)
     return blog
 
 @post('/api/blogs/{id}')
@@ -290,12 +369,20 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    blog.html_content = yield from render.markdown(blog.content)
     yield from blog.update()
+    invalidate_pages(blog.id)
     return blog
 
+@post('/api/preview')
+def api_preview(request, *, content):
+    check_admin(request)
+    return dict(html=(yield from render.markdown(content)))
+
 @post('/api/blogs/{id}/delete')
 def api_delete_blog(request, *, id):
     check_admin(request)
     blog = yield from Blog.find(id)
     yield from blog.remove()
+    invalidate_pages(id)
     return dict(id=id)
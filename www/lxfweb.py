@@ -1,15 +1,19 @@
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, time
 
 from urllib import parse
 
 from aiohttp import web
 
 from apis import APIError
+import metrics
 
-def get(path):
+logger = logging.getLogger('lxfweb')
+
+def get(path, *, public=False, page_cache=False):
     '''
-    Define decorator @get('/path')
+    Define decorator @get('/path'), public=True marks a route that needs no current user,
+    page_cache=True caches the rendered page for anonymous visitors.
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -17,12 +21,14 @@ def get(path):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__public__ = public
+        wrapper.__page_cache__ = page_cache
         return wrapper
     return decorator
 
-def post(path):
+def post(path, *, public=False):
     '''
-    Define decorator @post('/path')
+    Define decorator @post('/path'), public=True marks a route that needs no current user.
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -30,9 +36,16 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__public__ = public
         return wrapper
     return decorator
 
+def is_public(request):
+    '''
+    Static files and routes defined with public=True skip cookie parsing in auth_factory.
+    '''
+    return request.path.startswith(STATIC_PREFIX) or getattr(request.match_info.handler, '__public__', False)
+
 def get_required_kw_args(fn):
     args = []
     params = inspect.signature(fn).parameters
@@ -73,74 +86,111 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
-class RequestHandler(object):
+def compile_binder(fn):
+    '''
+    Build the argument binder of fn once at add_route time, specialized by its signature:
+    path-only, query string (GET) or JSON/form body (POST).
+    Return (bind, is_coroutine), bind(request) returns kw for fn or a web.Response on bad request.
+    '''
+    has_request = has_request_arg(fn)
+    has_var_kw = has_var_kw_arg(fn)
+    named_kw_args = get_named_kw_args(fn)
+    required_kw_args = get_required_kw_args(fn)
 
-    def __init__(self, app, fn):
-        self._app = app
-        self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+    if not has_var_kw and not named_kw_args:
+        if has_request:
+            def bind_path(request):
+                kw = dict(**request.match_info)
+                kw['request'] = request
+                return kw
+            return bind_path, False
+        def bind_path(request):
+            return dict(**request.match_info)
+        return bind_path, False
 
-    @asyncio.coroutine
-    def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = yield from request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = yield from request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
+    # None means keep all params:
+    names = None if has_var_kw else frozenset(named_kw_args)
+
+    def finish(request, kw):
         if kw is None:
             kw = dict(**request.match_info)
         else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
             for k, v in request.match_info.items():
                 if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                    logger.warning('Duplicate arg name in named arg and kw args: %s', k)
                 kw[k] = v
-        if self._has_request_arg:
+        if has_request:
             kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        for name in required_kw_args:
+            if not name in kw:
+                return web.HTTPBadRequest('Missing argument: %s' % name)
+        return kw
+
+    if getattr(fn, '__method__', None) == 'POST':
+        @asyncio.coroutine
+        def bind_body(request):
+            if not request.content_type:
+                return web.HTTPBadRequest('Missing Content-Type.')
+            ct = request.content_type.lower()
+            if ct.startswith('application/json'):
+                params = yield from request.json()
+                if not isinstance(params, dict):
+                    return web.HTTPBadRequest('JSON body must be object.')
+            elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                params = yield from request.post()
+            else:
+                return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
+            if names is None:
+                kw = dict(**params)
+            else:
+                kw = {k: params[k] for k in names if k in params}
+            return finish(request, kw)
+        return bind_body, True
+
+    def bind_query(request):
+        qs = request.query_string
+        if not qs:
+            return finish(request, None)
+        if names is None:
+            kw = {k: v[0] for k, v in parse.parse_qs(qs, True).items()}
+        else:
+            kw = {k: v[0] for k, v in parse.parse_qs(qs, True).items() if k in names}
+        return finish(request, kw)
+    return bind_query, False
+
+class RequestHandler(object):
+
+    def __init__(self, app, fn):
+        self._app = app
+        self._func = fn
+        self.__public__ = getattr(fn, '__public__', False)
+        self.__page_cache__ = getattr(fn, '__page_cache__', False)
+        self._bind, self._bind_is_coroutine = compile_binder(fn)
+
+    @asyncio.coroutine
+    def __call__(self, request):
+        if self._bind_is_coroutine:
+            kw = yield from self._bind(request)
+        else:
+            kw = self._bind(request)
+        if not isinstance(kw, dict):
+            return kw
+        logger.debug('call with args: %s', kw)
+        start = time.perf_counter()
         try:
             r = yield from self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        finally:
+            metrics.record('handler', start)
+
+STATIC_PREFIX = '/static/'
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
 def add_static(app):
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
-    logging.info('add static %s => %s' % ('/static/', path))
+    app.router.add_static(STATIC_PREFIX, STATIC_PATH)
+    logging.info('add static %s => %s' % (STATIC_PREFIX, STATIC_PATH))
 
 def add_route(app, fn):
     method = getattr(fn, '__method__', None)
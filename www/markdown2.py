@@ -79,9 +79,11 @@ __author__ = "Trent Mick"
 
 import os
 import sys
+import threading
 from pprint import pprint, pformat
 import re
 import logging
+from bisect import bisect_left
 try:
     from hashlib import md5
 except ImportError:
@@ -153,18 +155,54 @@ def markdown_path(path, encoding="utf-8",
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    return _converter(html4tags, tab_width, safe_mode, extras,
+                      link_patterns, use_file_vars).convert(text)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    return _converter(html4tags, tab_width, safe_mode, extras,
+                      link_patterns, use_file_vars).convert(text)
+
+# Shared `Markdown` instances of `markdown()` and `markdown_path()`, keyed by
+# their options. `Markdown.convert()` is re-entrant, so one instance per key
+# serves all threads.
+_converters = {}
+_converters_lock = threading.Lock()
+_MAX_CONVERTERS = 64
+
+def _converter(html4tags, tab_width, safe_mode, extras, link_patterns,
+               use_file_vars):
+    """Return a `Markdown` instance for these options, reused across calls.
+
+        >>> _converter(False, 4, None, ["toc"], None, False) is \\
+        ...     _converter(False, 4, None, {"toc": None}, None, False)
+        True
+    """
+    if isinstance(extras, dict):
+        extras_key = tuple(sorted(extras.items()))
+    elif extras:
+        extras_key = tuple(sorted(dict([(e, None) for e in extras]).items()))
+    else:
+        extras_key = ()
+    key = (html4tags, tab_width, safe_mode, extras_key,
+           tuple(link_patterns or ()), use_file_vars)
+    try:
+        md = _converters.get(key)
+    except TypeError:
+        # unhashable extra argument or link pattern: don't cache
+        md = key = None
+    if md is None:
+        md = Markdown(html4tags=html4tags, tab_width=tab_width,
+                      safe_mode=safe_mode, extras=extras,
+                      link_patterns=link_patterns,
+                      use_file_vars=use_file_vars)
+        if key is not None:
+            with _converters_lock:
+                if len(_converters) >= _MAX_CONVERTERS:
+                    _converters.clear()
+                md = _converters.setdefault(key, md)
+    return md
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -240,24 +278,40 @@ class Markdown(object):
             self._count_from_header_id = {} # no `defaultdict` in Python 2.4
         if "metadata" in self.extras:
             self.metadata = {}
+        self._toc = None
+
+    def _fork(self):
+        """Return a copy of this instance to hold the state of one conversion.
+
+        The copy shares the options and regexes set up by `__init__`, and
+        gets its own urls, titles, html blocks etc. from `reset()`.
+        """
+        md = object.__new__(self.__class__)
+        md.__dict__.update(self.__dict__)
+        # `_encode_code()` adds to the escape table:
+        md._escape_table = self._escape_table.copy()
+        md.reset()
+        return md
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
     _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
 
     def convert(self, text):
-        """Convert the given text."""
+        """Convert the given text.
+
+        Re-entrant: the state of the conversion lives on a copy of this
+        instance (see `_fork()`), so one instance can be reused and shared
+        by threads.
+        """
+        return self._fork()._convert(text)
+
+    def _convert(self, text):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
         # and <img> tags get encoded.
 
-        # Clear the global hashes. If we don't clear these, you get conflicts
-        # from other articles when generating a page which contains more than
-        # one article (e.g. an index page that shows the N most recent
-        # articles):
-        self.reset()
-
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
@@ -1079,41 +1133,48 @@ class Markdown(object):
         match = self._whitespace.match(text, start)
         return match.end()
 
-    def _find_balanced(self, text, start, open_c, close_c):
-        """Returns the index where the open_c and close_c characters balance
-        out - the same number of open_c and close_c are encountered - or the
-        end of string if it's reached before the balance point is found.
-        """
-        i = start
-        l = len(text)
-        count = 1
-        while count > 0 and i < l:
-            if text[i] == open_c:
-                count += 1
-            elif text[i] == close_c:
-                count -= 1
-            i += 1
-        return i
-
-    def _extract_url_and_title(self, text, start):
+    def _extract_url_and_title(self, links, start):
         """Extracts the url and (optional) title from the tail of a link"""
         # text[start] equals the opening parenthesis
+        text = links.text
         idx = self._find_non_whitespace(text, start+1)
         if idx == len(text):
             return None, None, None
         end_idx = idx
         has_anglebrackets = text[idx] == "<"
         if has_anglebrackets:
-            end_idx = self._find_balanced(text, end_idx+1, "<", ">")
-        end_idx = self._find_balanced(text, end_idx, "(", ")")
-        match = self._inline_link_title.search(text, idx, end_idx)
-        if not match:
+            end_idx = links.angles.find_balanced(end_idx+1)
+        end_idx = links.parens.find_balanced(end_idx)
+        # `_inline_link_title` is anchored at `\)$`: without a ')' ending
+        # text[:end_idx] (the parenthesis never closes) there is no link
+        if text[end_idx-1] == ')':
+            close = end_idx - 1
+        elif text[end_idx-1] == '\n' and text[end_idx-2:end_idx-1] == ')':
+            close = end_idx - 2
+        else:
             return None, None, None
-        url, title = text[idx:match.start()], match.group("title")
+        if close < idx:
+            return None, None, None
+        url_end, title = links.find_title(idx, close)
+        url = text[idx:url_end]
         if has_anglebrackets:
             url = self._strip_anglebrackets.sub(r'\1', url)
         return url, title, end_idx
 
+    _tail_of_reference_link_head_re = re.compile(r"[ ]?(?:\n[ ]*)?\[")
+
+    def _match_tail_of_reference_link(self, links, pos):
+        """Match `_tail_of_reference_link_re` at `pos`, returns
+        `(link_id, end)` or `(None, None)`. The id ends at the next ']',
+        looked up in `links` instead of searched for.
+        """
+        match = self._tail_of_reference_link_head_re.match(links.text, pos)
+        if match:
+            close = links.brackets.next_close(match.end())
+            if close != -1:
+                return links.text[match.end():close], close + 1
+        return None, None
+
     def _do_links(self, text):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
         This is a combination of Markdown.pl's _DoAnchors() and
@@ -1121,15 +1182,39 @@ class Markdown(object):
         approach. It was necessary to use a different approach than
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
+
+        Runs in one pass over the text: where brackets and parentheses
+        balance out is looked up in a `_LinkIndex` built once, instead of
+        scanning ahead from every '[', and the result is joined from
+        pieces instead of splicing every link into the text.
+        """
+        if '[' not in text:
+            return text
+        pieces = []
+        self._do_links_between(_LinkIndex(text), 0, len(text), True, pieces)
+        return ''.join(pieces)
+
+    def _do_links_between(self, links, pos, end, anchor_allowed, pieces,
+                          escape_quotes=False):
+        """Append `text[pos:end]` with links converted to `pieces`.
+
+        Anchors are converted only if `anchor_allowed`: the text of an
+        anchor is converted by a nested call, which allows imgs but no
+        anchors inside anchors. With `escape_quotes` '"' outside of links
+        is escaped, for "smarty-pants".
         """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
-        # `anchor_allowed_pos` is used to support img links inside
-        # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
-
-        curr_pos = 0
+        text = links.text
+        text_length = len(text)
+        if escape_quotes:
+            quote = self._escape_table['"']
+            def append_text(s):
+                pieces.append(s.replace('"', quote))
+        else:
+            append_text = pieces.append
+        done = pos      # text[pos:done] is in pieces
+        curr_pos = pos
         while True: # Handle the next link.
             # The next '[' is the start of:
             # - an inline anchor:   [text](url "title")
@@ -1146,28 +1231,17 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
+            start_idx = text.find('[', curr_pos, end)
+            if start_idx == -1:
                 break
-            text_length = len(text)
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = links.brackets.find_close(start_idx+1)
+            if p == -1 or p >= start_idx+MAX_LINK_TEXT_SENTINEL:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
@@ -1182,25 +1256,25 @@ class Markdown(object):
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
-                else:
-                    # This id isn't defined, leave the markup alone.
-                    curr_pos = p+1
+                    append_text(text[done:start_idx])
+                    pieces.append(result)
+                    done = p+1
+                # else: this id isn't defined, leave the markup alone.
+                curr_pos = p+1
                 continue
 
             # Now determine what this is by the remainder.
+            link_text_end = p
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
-                url, title, url_end_idx = self._extract_url_and_title(text, p)
-                if url is not None:
+                url, title, url_end_idx = self._extract_url_and_title(links, p)
+                if url is not None and url_end_idx <= end:
                     # Handle an inline anchor or img.
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
-                    if is_img:
-                        start_idx -= 1
 
                     # We've got to encode these to avoid conflicting
                     # with italics/bold.
@@ -1221,18 +1295,15 @@ class Markdown(object):
                                title_str, img_class_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
+                        append_text(text[done:start_idx-1])
+                        pieces.append(result)
+                        done = curr_pos = url_end_idx
+                    elif anchor_allowed:
                         result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        append_text(text[done:start_idx])
+                        self._append_anchor(links, result_head, start_idx,
+                                            link_text_end, pieces)
+                        done = curr_pos = url_end_idx
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1240,13 +1311,11 @@ class Markdown(object):
 
             # Reference anchor or img?
             else:
-                match = self._tail_of_reference_link_re.match(text, p)
-                if match:
+                link_id, match_end = self._match_tail_of_reference_link(links, p)
+                if link_id is not None and match_end <= end:
                     # Handle a reference-style anchor or img.
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
-                    if is_img:
-                        start_idx -= 1
-                    link_id = match.group("id").lower()
+                    link_id = link_id.lower()
                     if not link_id:
                         link_id = link_text.lower()  # for links like [this][]
                     if link_id in self.urls:
@@ -1257,7 +1326,6 @@ class Markdown(object):
                                  .replace('_', self._escape_table['_'])
                         title = self.titles.get(link_id)
                         if title:
-                            before = title
                             title = _xml_escape_attr(title) \
                                 .replace('*', self._escape_table['*']) \
                                 .replace('_', self._escape_table['_'])
@@ -1272,32 +1340,40 @@ class Markdown(object):
                                    title_str, img_class_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
+                            append_text(text[done:start_idx-1])
+                            pieces.append(result)
+                            done = curr_pos = match_end
+                        elif anchor_allowed:
                             result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            append_text(text[done:start_idx])
+                            self._append_anchor(links, result_head, start_idx,
+                                                link_text_end, pieces)
+                            done = curr_pos = match_end
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
                     else:
                         # This id isn't defined, leave the markup alone.
-                        curr_pos = match.end()
+                        curr_pos = match_end
                     continue
 
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        append_text(text[done:end])
+
+    def _append_anchor(self, links, result_head, start_idx, link_text_end,
+                       pieces):
+        """Append an anchor to `pieces`, its link text converted for imgs
+        inside the anchor.
+        """
+        smarty_pants = "smarty-pants" in self.extras
+        if smarty_pants:
+            result_head = result_head.replace('"', self._escape_table['"'])
+        pieces.append(result_head)
+        self._do_links_between(links, start_idx+1, link_text_end, False,
+                               pieces, escape_quotes=smarty_pants)
+        pieces.append('</a>')
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1985,6 +2061,121 @@ class MarkdownWithExtras(Markdown):
 
 #---- internal support functions
 
+class _Balancer(object):
+    """Where `open_c` and `close_c` characters of a text balance out.
+
+    Built by one pass over the text, a lookup costs O(log n) instead of a
+    scan from the start position.
+
+        >>> b = _Balancer("a(b(c)d)e)", "(", ")")
+        >>> b.find_close(2), b.find_close(4), b.find_close(0)
+        (7, 5, 9)
+        >>> b.find_balanced(8), _Balancer("(x", "(", ")").find_balanced(1)
+        (10, 2)
+    """
+    def __init__(self, text, open_c, close_c):
+        self.text_length = len(text)
+        self.positions = []     # positions of open_c and close_c
+        self.depths = []        # nesting depth after each of them
+        self.closes = []        # positions of close_c
+        self.closes_by_depth = {}
+        depth = 0
+        for match in re.finditer("[%s]" % re.escape(open_c + close_c), text):
+            pos = match.start()
+            if match.group() == open_c:
+                depth += 1
+            else:
+                depth -= 1
+                self.closes.append(pos)
+                self.closes_by_depth.setdefault(depth, []).append(pos)
+            self.positions.append(pos)
+            self.depths.append(depth)
+
+    def find_close(self, start):
+        """Return the position of the `close_c` where `text[start:]` has one
+        `close_c` more than `open_c`, or -1.
+        """
+        # the running count of the scan hits -1 at the first `close_c`
+        # after start leaving the nesting depth one below that at start
+        i = bisect_left(self.positions, start)
+        depth = i and self.depths[i-1]
+        closes = self.closes_by_depth.get(depth - 1)
+        if closes:
+            i = bisect_left(closes, start)
+            if i < len(closes):
+                return closes[i]
+        return -1
+
+    def find_balanced(self, start):
+        """Return the index after the `close_c` where `text[start:]` has one
+        `close_c` more than `open_c`, or the end of the text.
+        """
+        close = self.find_close(start)
+        if close == -1:
+            return self.text_length
+        return close + 1
+
+    def next_close(self, start):
+        """Return the position of the first `close_c` at or after start,
+        or -1.
+        """
+        i = bisect_left(self.closes, start)
+        if i < len(self.closes):
+            return self.closes[i]
+        return -1
+
+class _LinkIndex(object):
+    """A text being converted by `Markdown._do_links()`, with `_Balancer`
+    indexes of its brackets, parentheses and (built on first use) angle
+    brackets and link titles.
+    """
+    _title_head_re = re.compile(r"[ \t]+(['\"])")
+
+    def __init__(self, text):
+        self.text = text
+        self.brackets = _Balancer(text, "[", "]")
+        self.parens = _Balancer(text, "(", ")")
+        self._angles = None
+        self._title_heads = None
+
+    @property
+    def angles(self):
+        if self._angles is None:
+            self._angles = _Balancer(self.text, "<", ">")
+        return self._angles
+
+    def find_title(self, start, close):
+        """Where `Markdown._inline_link_title` matches first in
+        `text[start:close+1]`, `text[close]` being ')': return the start of
+        the match and the title, or `(close, None)` without a title.
+
+        The title is quoted by `text[close-1]`, its opening quote is the
+        first quote of that kind after blanks past start, looked up in an
+        index of blanks followed by a quote instead of searched for.
+
+            >>> links = _LinkIndex('(u "a" "b")')
+            >>> links.find_title(1, 10), links.find_title(4, 10)
+            ((2, 'a" "b'), (6, 'b'))
+            >>> links.find_title(1, 2)
+            (2, None)
+        """
+        text = self.text
+        quote = text[close-1:close]
+        if quote not in ('"', "'"):
+            return close, None
+        if self._title_heads is None:
+            # quote => positions of the quotes, starts of the blanks before
+            self._title_heads = {'"': ([], []), "'": ([], [])}
+            for match in self._title_head_re.finditer(text):
+                quotes, blanks = self._title_heads[match.group(1)]
+                quotes.append(match.start(1))
+                blanks.append(match.start())
+        quotes, blanks = self._title_heads[quote]
+        i = bisect_left(quotes, start + 1)
+        if i == len(quotes) or quotes[i] >= close - 1:
+            return close, None
+        return max(blanks[i], start), text[quotes[i]+1:close-1]
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
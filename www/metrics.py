@@ -0,0 +1,157 @@
+'''
+In-process request timing: per-phase durations of the current request and latency histograms.
+'''
+
+import os, time, bisect, heapq, contextvars
+
+# upper bounds (ms) of histogram buckets, the last bucket is unbounded:
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Histogram(object):
+    '''
+    Latency histogram in ms.
+    '''
+
+    def __init__(self):
+        '''
+        >>> h = Histogram()
+        >>> for ms in (1, 3, 3, 40, 700): h.observe(ms)
+        >>> h.count, h.max
+        (5, 700)
+        >>> h.percentile(50)
+        5
+        >>> h.percentile(99)
+        1000
+        '''
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count = self.count + 1
+        self.total = self.total + ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        ' return upper bound of the bucket holding the p-th percentile. '
+        if self.count == 0:
+            return None
+        rank = self.count * p / 100.0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n = n + c
+            if n >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, total_ms=round(self.total, 3), max_ms=round(self.max, 3),
+                    avg_ms=round(self.total / self.count, 3) if self.count else None,
+                    p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99),
+                    buckets=dict(zip([str(b) for b in BUCKETS] + ['inf'], self.counts)))
+
+class RequestTimer(object):
+    '''
+    Phase durations (ms) and SQL statistics of one request.
+    '''
+
+    def __init__(self, path=None):
+        self.start = time.perf_counter()
+        self.path = path
+        self.phases = dict()
+        self.shapes = dict()
+        self.query_count = 0
+        self.query_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_sql = None
+
+    def add(self, phase, ms):
+        self.phases[phase] = self.phases.get(phase, 0.0) + ms
+
+    def add_query(self, sql, ms, shape=None):
+        ' add a query, return how many times its shape was issued in this request. '
+        n = self.shapes.get(shape, 0) + 1
+        self.shapes[shape] = n
+        self.query_count = self.query_count + 1
+        self.query_ms = self.query_ms + ms
+        if ms > self.slowest_ms:
+            self.slowest_ms = ms
+            self.slowest_sql = sql
+        return n
+
+    def server_timing(self, total_ms):
+        ' format as Server-Timing header value. '
+        L = ['total;dur=%.2f' % total_ms]
+        for phase, ms in self.phases.items():
+            L.append('%s;dur=%.2f' % (phase, ms))
+        if self.query_count:
+            L.append('sql;dur=%.2f;desc="%s queries"' % (self.query_ms, self.query_count))
+        return ', '.join(L)
+
+histograms = dict()
+
+# normalized SQL => Histogram:
+sql_shapes = dict()
+
+# the SLOW_KEEP slowest queries seen so far as (ms, sql):
+SLOW_KEEP = 10
+slow_queries = []
+
+_timer = contextvars.ContextVar('request_timer', default=None)
+
+def begin_request(path=None):
+    ' start timing the request of the current task, return (timer, token) for end_request. '
+    timer = RequestTimer(path)
+    return timer, _timer.set(timer)
+
+def end_request(token):
+    ' stop timing, feed the histograms and return total ms. '
+    timer = _timer.get()
+    _timer.reset(token)
+    total_ms = (time.perf_counter() - timer.start) * 1000
+    observe('request', total_ms)
+    for phase, ms in timer.phases.items():
+        observe(phase, ms)
+    if timer.query_count:
+        observe('sql', timer.query_ms)
+        entry = (timer.slowest_ms, timer.slowest_sql)
+        if len(slow_queries) < SLOW_KEEP:
+            heapq.heappush(slow_queries, entry)
+        elif entry > slow_queries[0]:
+            heapq.heapreplace(slow_queries, entry)
+    return total_ms
+
+def observe(name, ms):
+    h = histograms.get(name)
+    if h is None:
+        h = histograms[name] = Histogram()
+    h.observe(ms)
+
+def record(phase, start):
+    ' add time since start (a time.perf_counter() value) to phase of the current request. '
+    timer = _timer.get()
+    if timer is not None:
+        timer.add(phase, (time.perf_counter() - start) * 1000)
+
+def current():
+    ' return RequestTimer of the current request or None. '
+    return _timer.get()
+
+def observe_sql(shape, ms):
+    h = sql_shapes.get(shape)
+    if h is None:
+        h = sql_shapes[shape] = Histogram()
+    h.observe(ms)
+
+def snapshot():
+    # numbers are per process, pid tells which worker of supervisor.py answered:
+    return dict(pid=os.getpid(), histograms=dict((name, h.snapshot()) for name, h in histograms.items()),
+                slowest_sql=[dict(ms=round(ms, 3), sql=sql) for ms, sql in sorted(slow_queries, reverse=True)],
+                sql_shapes=dict((shape, h.snapshot()) for shape, h in sql_shapes.items()))
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,6 @@
+-- pre-rendered markdown of blogs.content, written by api_create_blog / api_update_blog.
+-- existing rows stay null until filled by: python3 backfill.py
+
+use awesome;
+
+alter table blogs add column `html_content` mediumtext after `content`;
@@ -1,6 +1,7 @@
 import time, uuid
 
 from orm import Model, StringField, BooleanField, FloatField, TextField
+import cache
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
@@ -16,6 +17,10 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(default=time.time)
 
+    def onChange(self):
+        # cached sessions must not outlive a password change or removal:
+        cache.session_cache.evict_tag('user:%s' % self.id)
+
 class Blog(Model):
     __table__ = 'blogs'
 
@@ -26,8 +31,12 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    html_content = TextField(lazy=True)
     created_at = FloatField(default=time.time)
 
+    def onChange(self):
+        cache.html_cache.evict_tag('blog:%s' % self.id)
+
 class Comment(Model):
     __table__ = 'comments'
 
@@ -1,9 +1,60 @@
-import asyncio, logging
+import asyncio, logging, time, functools, contextvars, re
+
+from collections import deque
 
 import aiomysql
 
+import metrics
+
+# per query logging, at DEBUG so the SQL is only formatted when enabled:
+logger = logging.getLogger('orm')
+
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logger.debug('SQL: %s', sql)
+
+# queries slower than SLOW_QUERY_MS are logged to 'orm.slow', the same SQL shape issued
+# more than REPEAT_QUERY_LIMIT times in one request (N+1 from find() in a loop) to 'orm.repeat':
+SLOW_QUERY_MS = 200
+REPEAT_QUERY_LIMIT = 10
+
+slow_logger = logging.getLogger('orm.slow')
+repeat_logger = logging.getLogger('orm.repeat')
+
+def set_query_monitor(slow_query_ms=None, repeat_query_limit=None):
+    global SLOW_QUERY_MS, REPEAT_QUERY_LIMIT
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+    if repeat_query_limit is not None:
+        REPEAT_QUERY_LIMIT = repeat_query_limit
+
+_RE_ARGS_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    '''
+    Return the shape of sql: in (...) lists and multi-row values collapse to (?), numbers to ?.
+    >>> normalize_sql('delete from `t` where `id` in (?, ?, ?)')
+    'delete from `t` where `id` in (?)'
+    >>> normalize_sql('insert into `t` (`a`, `id`) values (?, ?), (?, ?)')
+    'insert into `t` (`a`, `id`) values (?)'
+    >>> normalize_sql('select * from `t` limit 10')
+    'select * from `t` limit ?'
+    '''
+    return _RE_NUMBER.sub('?', _RE_ARGS_LIST.sub('(?)', sql))
+
+def query_done(sql, start):
+    ' record wall time of sql started at start (time.perf_counter()), log slow and repeated queries. '
+    ms = (time.perf_counter() - start) * 1000
+    shape = normalize_sql(sql)
+    metrics.observe_sql(shape, ms)
+    if ms >= SLOW_QUERY_MS:
+        slow_logger.warning('slow query (%.1f ms): %s', ms, sql)
+    timer = metrics.current()
+    if timer is not None:
+        n = timer.add_query(sql, ms, shape)
+        if n == REPEAT_QUERY_LIMIT + 1:
+            repeat_logger.warning('query issued more than %s times in request %s (N+1?): %s', REPEAT_QUERY_LIMIT, timer.path, shape)
 
 @asyncio.coroutine
 def create_pool(loop, **kw):
@@ -22,40 +73,243 @@ def create_pool(loop, **kw):
         loop=loop
     )
 
+@asyncio.coroutine
+def close_pool():
+    logging.info('close database connection pool...')
+    global __pool
+    __pool.close()
+    yield from __pool.wait_closed()
+
+@functools.lru_cache(maxsize=1024)
+def driver_sql(sql):
+    ' convert ? placeholders to the %s paramstyle of aiomysql, memoized per SQL string. '
+    return sql.replace('?', '%s')
+
 @asyncio.coroutine
 def select(sql, args, size=None):
     log(sql, args)
     global __pool
     with (yield from __pool) as conn:
+        # time the query only, not the wait for a connection:
+        start = time.perf_counter()
         cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
+        yield from cur.execute(driver_sql(sql), args or ())
         if size:
             rs = yield from cur.fetchmany(size)
         else:
             rs = yield from cur.fetchall()
         yield from cur.close()
-        logging.info('rows returned: %s' % len(rs))
+        query_done(sql, start)
+        logger.debug('rows returned: %s', len(rs))
         return rs
 
+class SelectCursor(object):
+    '''
+    Async iterator over the rows of a query, read in batches of batch_size from an
+    unbuffered server-side cursor, so only one batch is held in memory.
+    The connection is taken from the pool on the first row and released when the rows
+    are exhausted or on close().
+    '''
+
+    def __init__(self, sql, args, batch_size=100, factory=None):
+        self._sql = sql
+        self._args = args
+        self._batch_size = batch_size
+        self._factory = factory
+        self._conn = None
+        self._cur = None
+        self._rows = deque()
+        self._done = False
+
+    def map(self, fn):
+        ' apply fn to each row after factory, return self. '
+        factory = self._factory
+        self._factory = fn if factory is None else lambda r: fn(factory(r))
+        return self
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._rows:
+            if self._done:
+                raise StopAsyncIteration
+            try:
+                if self._cur is None:
+                    log(self._sql, self._args)
+                    self._conn = yield from _acquire()
+                    start = time.perf_counter()
+                    self._cur = yield from self._conn.cursor(aiomysql.SSDictCursor)
+                    yield from self._cur.execute(driver_sql(self._sql), self._args or ())
+                    query_done(self._sql, start)
+                rs = yield from self._cur.fetchmany(self._batch_size)
+            except BaseException:
+                yield from self.close()
+                raise
+            if not rs:
+                yield from self.close()
+                raise StopAsyncIteration
+            self._rows.extend(rs)
+        row = self._rows.popleft()
+        return row if self._factory is None else self._factory(row)
+
+    @asyncio.coroutine
+    def close(self):
+        self._done = True
+        self._rows.clear()
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            yield from cur.close()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            _release(conn)
+
+@asyncio.coroutine
+def _acquire():
+    return (yield from __pool.acquire())
+
+def _release(conn):
+    __pool.release(conn)
+
 @asyncio.coroutine
 def execute(sql, args, autocommit=True):
     log(sql)
     with (yield from __pool) as conn:
+        start = time.perf_counter()
         if not autocommit:
             yield from conn.begin()
         try:
             cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
+            yield from cur.execute(driver_sql(sql), args)
             affected = cur.rowcount
             yield from cur.close()
             if not autocommit:
                 yield from conn.commit()
+            query_done(sql, start)
         except BaseException as e:
             if not autocommit:
                 yield from conn.rollback()
             raise
         return affected
 
+@asyncio.coroutine
+def execute_batch(batch):
+    ' execute list of (sql, args, many) in one transaction, many=True runs executemany over a list of args. '
+    with (yield from __pool) as conn:
+        yield from conn.begin()
+        try:
+            cur = yield from conn.cursor()
+            affected = 0
+            for sql, args, many in batch:
+                log(sql)
+                start = time.perf_counter()
+                if many:
+                    yield from cur.executemany(driver_sql(sql), args)
+                else:
+                    yield from cur.execute(driver_sql(sql), args)
+                query_done(sql, start)
+                affected = affected + cur.rowcount
+            yield from cur.close()
+            yield from conn.commit()
+        except BaseException as e:
+            yield from conn.rollback()
+            raise
+        return affected
+
+# cached row count per table: table -> [count, reconciled_at, exact].
+# Model.save/remove keep it up to date, it is reconciled by count(*) after COUNTER_TTL seconds:
+COUNTER_TTL = 300
+_counters = dict()
+
+def _count_changed(table, delta):
+    c = _counters.get(table)
+    if c is not None:
+        c[0] = max(c[0] + delta, 0)
+
+@functools.lru_cache(maxsize=1024)
+def _find_all_sql(cls, where, orderBy, limitShape, seek):
+    ' build SQL of Model.findAll once per (model, where, orderBy, limit shape, seek). '
+    sql = [cls.__select__]
+    if seek:
+        seek_where = '(`created_at`<? or (`created_at`=? and `%s`<?))' % cls.__primary_key__
+        where = '(%s) and %s' % (where, seek_where) if where else seek_where
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limitShape == 1:
+        sql.append('limit ?')
+    elif limitShape == 2:
+        sql.append('limit ?, ?')
+    return ' '.join(sql)
+
+@functools.lru_cache(maxsize=1024)
+def _find_number_sql(cls, selectField, where):
+    sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    return ' '.join(sql)
+
+@functools.lru_cache(maxsize=64)
+def _update_sql(cls, fields):
+    ' build SQL of Model.update for models missing lazy fields, which are left as they are. '
+    return 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__)
+
+class UnitOfWork(object):
+    '''
+    Request scoped identity map: Model.find/findAll return one instance per primary key,
+    and models marked dirty are flushed together at the end of the request.
+    '''
+
+    def __init__(self):
+        self._identities = dict()
+        self._dirty = dict()
+
+    def get(self, cls, pk):
+        return self._identities.get((cls.__table__, pk))
+
+    def add(self, model):
+        ' register model, return the instance already loaded for the same primary key if any. '
+        key = (model.__table__, model.getValue(model.__primary_key__))
+        return self._identities.setdefault(key, model)
+
+    def discard(self, model):
+        key = (model.__table__, model.getValue(model.__primary_key__))
+        self._identities.pop(key, None)
+        self._dirty.pop(key, None)
+
+    def markDirty(self, model):
+        key = (model.__table__, model.getValue(model.__primary_key__))
+        self._identities.setdefault(key, model)
+        self._dirty[key] = model
+
+    def clean(self, model):
+        self._dirty.pop((model.__table__, model.getValue(model.__primary_key__)), None)
+
+    @asyncio.coroutine
+    def flush(self):
+        ' update all dirty models, one updateAll per model class. '
+        groups = dict()
+        for model in self._dirty.values():
+            groups.setdefault(model.__class__, []).append(model)
+        self._dirty.clear()
+        for cls, models in groups.items():
+            yield from cls.updateAll(models)
+
+_unit_of_work = contextvars.ContextVar('unit_of_work', default=None)
+
+def begin_unit_of_work():
+    ' start a unit of work for the current task, return (uow, token) for end_unit_of_work. '
+    uow = UnitOfWork()
+    return uow, _unit_of_work.set(uow)
+
+def end_unit_of_work(token):
+    _unit_of_work.reset(token)
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -69,6 +323,7 @@ class Field(object):
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.lazy = False
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -95,8 +350,10 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
+    def __init__(self, name=None, default=None, lazy=False):
         super().__init__(name, 'text', False, default)
+        # lazy: not selected by findAll/iterate, only by find:
+        self.lazy = lazy
 
 class ModelMetaclass(type):
 
@@ -124,14 +381,19 @@ class ModelMetaclass(type):
         for k in mappings.keys():
             attrs.pop(k)
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
+        lazy_fields = [f for f in fields if mappings[f].lazy]
         attrs['__mappings__'] = mappings # 保存属性和列的映射关系
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey # 主键属性名
         attrs['__fields__'] = fields # 除主键外的属性名
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        attrs['__lazy_fields__'] = lazy_fields # findAll不查询的大字段
+        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(['`%s`' % f for f in fields if f not in lazy_fields]), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values ' % (tableName, ', '.join(escaped_fields), primaryKey)
+        attrs['__find__'] = 'select `%s`, %s from `%s` where `%s`=?' % (primaryKey, ', '.join(escaped_fields), tableName, primaryKey)
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        attrs['__delete_many__'] = 'delete from `%s` where `%s` in ' % (tableName, primaryKey)
         return type.__new__(cls, name, bases, attrs)
 
 class Model(dict, metaclass=ModelMetaclass):
@@ -151,65 +413,121 @@ class Model(dict, metaclass=ModelMetaclass):
     def getValue(self, key):
         return getattr(self, key, None)
 
+    def loadedFields(self):
+        ' fields to write back: all but the lazy fields not loaded by findAll. '
+        if all(f in self for f in self.__lazy_fields__):
+            return self.__fields__
+        return tuple(f for f in self.__fields__ if f in self or f not in self.__lazy_fields__)
+
     def getValueOrDefault(self, key):
         value = getattr(self, key, None)
         if value is None:
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s: %s' % (key, str(value)))
+                logger.debug('using default value for %s: %s', key, value)
                 setattr(self, key, value)
         return value
 
+    @classmethod
+    def _findAllQuery(cls, where, args, kw):
+        args = [] if args is None else list(args)
+        seek = kw.get('seek', None)
+        if seek is not None:
+            args.extend((seek[0], seek[0], seek[1]))
+        limit = kw.get('limit', None)
+        if limit is None:
+            limitShape = 0
+        elif isinstance(limit, int):
+            limitShape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            limitShape = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        return _find_all_sql(cls, where, kw.get('orderBy', None), limitShape, seek is not None), args
+
+    @classmethod
+    def iterate(cls, where=None, args=None, batch_size=100, **kw):
+        '''
+        Return async iterator over objects found by where clause (orderBy, limit as findAll),
+        fetched batch_size rows at a time from a server-side cursor:
+
+            async for blog in Blog.iterate('`html_content` is null', batch_size=500):
+                ...
+
+        Objects are built lazily and not kept in the identity map, so memory stays bounded.
+        '''
+        sql, args = cls._findAllQuery(where, args, kw)
+        return SelectCursor(sql, args, batch_size, lambda r: cls(**r))
+
     @classmethod
     @asyncio.coroutine
     def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        '''
+        find objects by where clause, seek=(created_at, pk) continues keyset pagination in created_at desc order.
+        stream=True returns iterate(where, args, **kw) instead of a list.
+        '''
+        if kw.pop('stream', False):
+            return cls.iterate(where, args, **kw)
+        sql, args = cls._findAllQuery(where, args, kw)
+        rs = yield from select(sql, args)
+        uow = _unit_of_work.get()
+        if uow is None:
+            return [cls(**r) for r in rs]
+        return [uow.add(cls(**r)) for r in rs]
 
     @classmethod
     @asyncio.coroutine
     def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+        rs = yield from select(_find_number_sql(cls, selectField, where), args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
+    @classmethod
+    @asyncio.coroutine
+    def findCount(cls, estimate=False, at_least=1):
+        '''
+        find row count of table by counter cache, estimate=True uses information_schema instead of count(*) when stale.
+        table_rows of InnoDB is approximate (and cached for information_schema_stats_expiry by MySQL 8),
+        an estimate below at_least, the rows the caller needs to exist, is replaced by count(*).
+        '''
+        c = _counters.get(cls.__table__)
+        if c is not None and time.time() - c[1] < COUNTER_TTL and (c[2] or (estimate and c[0] >= at_least)):
+            return c[0]
+        num = None
+        if estimate:
+            rs = yield from select('select `table_rows` _num_ from `information_schema`.`tables` where `table_schema`=database() and `table_name`=?', [cls.__table__], 1)
+            if len(rs) > 0 and rs[0]['_num_'] is not None and int(rs[0]['_num_']) >= at_least:
+                num = int(rs[0]['_num_'])
+        exact = num is None
+        if exact:
+            num = yield from cls.findNumber('count(`%s`)' % cls.__primary_key__)
+        _counters[cls.__table__] = [num, time.time(), exact]
+        return num
+
     @classmethod
     @asyncio.coroutine
     def find(cls, pk):
-        ' find object by primary key. '
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        ' find object by primary key, from the identity map of the current unit of work if loaded. '
+        uow = _unit_of_work.get()
+        if uow is not None:
+            model = uow.get(cls, pk)
+            if model is not None and all(f in model for f in cls.__lazy_fields__):
+                return model
+        rs = yield from select(cls.__find__, [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        if uow is None:
+            return cls(**rs[0])
+        model = uow.add(cls(**rs[0]))
+        # loaded by findAll before, add the lazy fields:
+        for f in cls.__lazy_fields__:
+            model.setdefault(f, rs[0][f])
+        return model
 
     @asyncio.coroutine
     def save(self):
@@ -218,14 +536,25 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = yield from execute(self.__insert__, args)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        else:
+            _count_changed(self.__table__, 1)
+            uow = _unit_of_work.get()
+            if uow is not None:
+                uow.add(self)
 
     @asyncio.coroutine
     def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        fields = self.loadedFields()
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        sql = self.__update__ if fields is self.__fields__ else _update_sql(self.__class__, fields)
+        rows = yield from execute(sql, args)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        uow = _unit_of_work.get()
+        if uow is not None:
+            uow.clean(self)
+        self.onChange()
 
     @asyncio.coroutine
     def remove(self):
@@ -233,3 +562,93 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = yield from execute(self.__delete__, args)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        else:
+            _count_changed(self.__table__, -1)
+        uow = _unit_of_work.get()
+        if uow is not None:
+            uow.discard(self)
+        self.onChange()
+
+    def markDirty(self):
+        ' defer update() to the end of the current unit of work. '
+        uow = _unit_of_work.get()
+        if uow is None:
+            raise RuntimeError('No unit of work for deferred update of %s.' % self.__table__)
+        uow.markDirty(self)
+
+    def onChange(self):
+        ' called after the row was updated or removed, subclasses drop derived caches here. '
+        pass
+
+    @classmethod
+    @asyncio.coroutine
+    def saveAll(cls, models, batch_size=500):
+        ' insert models by multi-row insert statements in one transaction. '
+        batch = []
+        for i in range(0, len(models), batch_size):
+            chunk = models[i:i+batch_size]
+            args = []
+            for m in chunk:
+                args.extend(map(m.getValueOrDefault, cls.__fields__))
+                args.append(m.getValueOrDefault(cls.__primary_key__))
+            row = '(%s)' % create_args_string(len(cls.__fields__) + 1)
+            batch.append((cls.__insert_many__ + ', '.join([row] * len(chunk)), args, False))
+        if not batch:
+            return 0
+        rows = yield from execute_batch(batch)
+        if rows != len(models):
+            logging.warn('failed to insert records: affected rows: %s of %s' % (rows, len(models)))
+        _count_changed(cls.__table__, rows)
+        uow = _unit_of_work.get()
+        if uow is not None:
+            for m in models:
+                uow.add(m)
+        return rows
+
+    @classmethod
+    @asyncio.coroutine
+    def updateAll(cls, models):
+        ' update models by primary key with executemany in one transaction. '
+        if not models:
+            return 0
+        # one executemany per set of loaded fields:
+        groups = dict()
+        for m in models:
+            fields = m.loadedFields()
+            a = list(map(m.getValue, fields))
+            a.append(m.getValue(cls.__primary_key__))
+            groups.setdefault(tuple(fields), []).append(a)
+        batch = []
+        for fields, args in groups.items():
+            sql = cls.__update__ if len(fields) == len(cls.__fields__) else _update_sql(cls, fields)
+            batch.append((sql, args, True))
+        rows = yield from execute_batch(batch)
+        if rows != len(models):
+            logging.warn('failed to update by primary key: affected rows: %s of %s' % (rows, len(models)))
+        uow = _unit_of_work.get()
+        for m in models:
+            if uow is not None:
+                uow.clean(m)
+            m.onChange()
+        return rows
+
+    @classmethod
+    @asyncio.coroutine
+    def removeAll(cls, models, batch_size=500):
+        ' remove models by primary key with delete ... in (...) statements in one transaction. '
+        batch = []
+        for i in range(0, len(models), batch_size):
+            pks = [m.getValue(cls.__primary_key__) for m in models[i:i+batch_size]]
+            batch.append((cls.__delete_many__ + '(%s)' % create_args_string(len(pks)), pks, False))
+        if not batch:
+            return 0
+        rows = yield from execute_batch(batch)
+        if rows != len(models):
+            logging.warn('failed to remove by primary key: affected rows: %s of %s' % (rows, len(models)))
+        _count_changed(cls.__table__, -rows)
+        uow = _unit_of_work.get()
+        for m in models:
+            if uow is not None:
+                uow.discard(m)
+            m.onChange()
+        return rows
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Build step: write .gz (and .br if brotli is installed) siblings of the static files,
+served by app.compress_factory to clients accepting the encoding.
+
+Usage: python3 precompress.py [static dir]
+'''
+
+import os, sys, gzip, shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# fonts like .woff and images are compressed already:
+EXTENSIONS = ('.js', '.css', '.html', '.svg', '.json', '.txt', '.map', '.eot', '.ttf', '.otf')
+
+def log(s):
+    print('[Precompress] %s' % s)
+
+def is_fresh(target, source):
+    return os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+def precompress_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    gz = path + '.gz'
+    if not is_fresh(gz, path):
+        with open(gz, 'wb') as f:
+            # mtime=0 keeps the output stable across builds:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        shutil.copystat(path, gz)
+        log('%s: %s => %s bytes' % (gz, len(data), os.path.getsize(gz)))
+    if brotli is not None:
+        br = path + '.br'
+        if not is_fresh(br, path):
+            with open(br, 'wb') as f:
+                f.write(brotli.compress(data))
+            shutil.copystat(path, br)
+            log('%s: %s => %s bytes' % (br, len(data), os.path.getsize(br)))
+
+def precompress(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(EXTENSIONS):
+                precompress_file(os.path.join(dirpath, name))
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    precompress(root)
@@ -0,0 +1,81 @@
+'''
+Markdown rendering off the event loop.
+
+Documents of at least inline_max_chars are rendered by a process (or thread) pool,
+smaller ones inline, where the round-trip to the pool costs more than the rendering.
+'''
+
+import asyncio, logging, time, multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown2, metrics
+
+_executor = None
+_executor_args = None
+_inline_max_chars = 4096
+
+def init_executor(executor='process', workers=None, inline_max_chars=4096, start_method='forkserver'):
+    '''
+    Create the pool: executor is 'process', 'thread' or None to render everything inline.
+    Processes start by start_method, not fork: a forked child would inherit the event loop,
+    db connections and listening socket of the server.
+    >>> init_executor(None, inline_max_chars=0)
+    >>> asyncio.get_event_loop().run_until_complete(markdown('*hi*'))
+    '<p><em>hi</em></p>\\n'
+    '''
+    global _executor, _executor_args, _inline_max_chars
+    shutdown_executor()
+    _inline_max_chars = inline_max_chars
+    if executor == 'process':
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = 'spawn'
+        _executor_args = (workers, start_method)
+        _executor = _process_pool()
+        # start the pool now, the first request should not wait for it:
+        _executor.submit(markdown2.markdown, '').result()
+    elif executor == 'thread':
+        _executor = ThreadPoolExecutor(max_workers=workers)
+    elif executor is not None:
+        raise ValueError('Invalid markdown executor: %s' % executor)
+    logging.info('markdown executor: %s, workers: %s, inline below %s chars.' % (executor, workers, inline_max_chars))
+
+def _process_pool():
+    workers, start_method = _executor_args
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+def _restart_executor(broken):
+    ' replace the broken process pool, once for all requests that saw it break. '
+    global _executor
+    if _executor is broken:
+        logging.warning('markdown process pool broken, restart it.')
+        broken.shutdown(wait=False)
+        _executor = _process_pool()
+
+@asyncio.coroutine
+def markdown(text):
+    ' render markdown text to html, in the pool if text is large. '
+    start = time.perf_counter()
+    if _executor is None or len(text) < _inline_max_chars:
+        html = markdown2.markdown(text)
+    else:
+        executor = _executor
+        try:
+            html = yield from asyncio.get_event_loop().run_in_executor(executor, markdown2.markdown, text)
+        except BrokenProcessPool:
+            # a render process died (killed, crashed) and took the pool with it:
+            _restart_executor(executor)
+            html = yield from asyncio.get_event_loop().run_in_executor(_executor, markdown2.markdown, text)
+    metrics.record('markdown', start)
+    return html
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -27,6 +27,7 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
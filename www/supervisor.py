@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Run app.py in several worker processes, so requests are served on all cores.
+
+Usage: python3 supervisor.py [workers]
+
+Each worker is a fresh python3 app.py with its own event loop and db pool. Workers serve
+one socket bound here and passed down, or with configs.server.reuse_port each binds its own
+SO_REUSEPORT socket. Workers write a heartbeat to a pipe every heartbeat_interval seconds,
+a worker exited or silent for heartbeat_timeout seconds is replaced.
+
+Sessions, pages and row counts are cached per worker. With more than one worker they
+expire after configs.cache.multi_worker_ttl seconds, so a signout or password change
+reaches the other workers only after that delay.
+
+SIGHUP: start new workers (running the current code) and stop the old ones once the new
+        ones serve.
+SIGTERM, SIGINT: stop all workers gracefully and exit.
+'''
+
+import os, sys, time, signal, socket, select, subprocess
+
+from config import configs
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+# seconds a new worker may take to create its db pool and start serving:
+START_TIMEOUT = 30
+
+def log(s):
+    print('[Supervisor] %s' % s)
+
+def bind(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+class Worker(object):
+    '''
+    One app.py process and the read end of its heartbeat pipe.
+    '''
+
+    def __init__(self, sock=None, workers=1):
+        r, w = os.pipe()
+        args = [sys.executable, APP, '--heartbeat-fd', str(w), '--workers', str(workers)]
+        fds = [w]
+        if sock is not None:
+            args.extend(['--fd', str(sock.fileno())])
+            fds.append(sock.fileno())
+        self.process = subprocess.Popen(args, pass_fds=fds, cwd=os.path.dirname(APP))
+        os.close(w)
+        self.pid = self.process.pid
+        self.pipe = r
+        self.started = self.last_beat = time.time()
+        self.ready = False
+        self.stopped = None
+        log('Start worker [%s]...' % self.pid)
+
+    def beat(self):
+        ' read heartbeats, the first one tells the worker is serving. '
+        data = os.read(self.pipe, 4096)
+        if not data:
+            # worker closed the pipe, poll() reports its exit:
+            self.close()
+            return
+        self.last_beat = time.time()
+        if not self.ready:
+            self.ready = True
+            log('Worker [%s] serving.' % self.pid)
+
+    def alive(self, now):
+        if self.ready:
+            return now - self.last_beat < configs.server.heartbeat_timeout
+        return now - self.started < START_TIMEOUT
+
+    def stop(self, sig=signal.SIGTERM):
+        if self.process.poll() is None:
+            self.process.send_signal(sig)
+        if self.stopped is None:
+            self.stopped = time.time()
+
+    def close(self):
+        if self.pipe is not None:
+            os.close(self.pipe)
+            self.pipe = None
+
+class Supervisor(object):
+
+    def __init__(self, n):
+        self.n = n
+        self.sock = None if configs.server.reuse_port else bind(configs.server.host, configs.server.port)
+        # serving generation and the generation replaced by the last SIGHUP:
+        self.workers = []
+        self.retiring = []
+        self.restarting = False
+        self.stopping = False
+
+    def spawn(self):
+        self.workers.append(Worker(self.sock, self.n))
+
+    def on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.restarting = True
+        else:
+            self.stopping = True
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.on_signal)
+        log('Serving http://%s:%s with %s workers...' % (configs.server.host, configs.server.port, self.n))
+        for i in range(self.n):
+            self.spawn()
+        while self.workers or self.retiring:
+            if self.stopping:
+                self.stop_all()
+            elif self.restarting:
+                self.restart()
+            self.wait(configs.server.heartbeat_interval)
+            self.reap()
+            self.check()
+        if self.sock is not None:
+            self.sock.close()
+        log('All workers stopped.')
+
+    def restart(self):
+        log('Restart %s workers...' % len(self.workers))
+        self.restarting = False
+        self.retiring.extend(self.workers)
+        self.workers = []
+        for i in range(self.n):
+            self.spawn()
+
+    def stop_all(self):
+        for w in self.workers + self.retiring:
+            if w.stopped is None:
+                log('Stop worker [%s]...' % w.pid)
+                w.stop()
+
+    def wait(self, timeout):
+        pipes = dict((w.pipe, w) for w in self.workers + self.retiring if w.pipe is not None)
+        if not pipes:
+            time.sleep(timeout)
+            return
+        try:
+            readable = select.select(list(pipes), [], [], timeout)[0]
+        except InterruptedError:
+            return
+        for fd in readable:
+            pipes[fd].beat()
+
+    def reap(self):
+        for w in self.workers + self.retiring:
+            code = w.process.poll()
+            if code is None:
+                continue
+            w.close()
+            log('Worker [%s] ended with code %s.' % (w.pid, code))
+            if w in self.retiring:
+                self.retiring.remove(w)
+                continue
+            self.workers.remove(w)
+            if not self.stopping:
+                if time.time() - w.started < 1:
+                    # crashing at startup, don't spin:
+                    time.sleep(1)
+                self.spawn()
+
+    def check(self):
+        now = time.time()
+        for w in self.workers:
+            if w.stopped is None and not w.alive(now):
+                log('Worker [%s] not responding, kill it.' % w.pid)
+                w.stop(signal.SIGKILL)
+        if self.retiring and all(w.ready for w in self.workers):
+            for w in self.retiring:
+                if w.stopped is None:
+                    log('Stop old worker [%s]...' % w.pid)
+                    w.stop()
+        for w in self.workers + self.retiring:
+            if w.stopped is not None and now - w.stopped > configs.server.shutdown_timeout + 5:
+                w.stop(signal.SIGKILL)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else configs.server.workers
+    Supervisor(n or os.cpu_count() or 1).run()